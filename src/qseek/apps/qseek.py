@@ -32,6 +32,13 @@ parser.add_argument(
     help="increase verbosity of the log messages, repeat to increase. "
     "Default level is INFO",
 )
+parser.add_argument(
+    "--uvloop",
+    action="store_true",
+    default=False,
+    help="run on the uvloop event loop if installed. This disables the nested "
+    "event loops provided by nest_asyncio",
+)
 parser.add_argument(
     "--version",
     action="version",
@@ -223,7 +230,12 @@ except ImportError:
 
 
 def main() -> None:
-    from qseek.utils import CACHE_DIR, load_insights, setup_rich_logging
+    from qseek.utils import (
+        CACHE_DIR,
+        load_insights,
+        load_uvloop,
+        setup_rich_logging,
+    )
 
     load_insights()
     from rich import box
@@ -239,6 +251,8 @@ def main() -> None:
     log_level = logging.INFO - args.verbose * 10
     loop_debug = log_level < logging.INFO
     setup_rich_logging(level=log_level)
+    if args.uvloop:
+        load_uvloop()
 
     match args.command:
         case "config":
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
 import logging
 import os
 import re
@@ -550,6 +551,26 @@ def load_insights() -> None:
         logger.debug("package qseek.insights not installed")
 
 
+def load_uvloop() -> None:
+    """Install uvloop's event loop policy.
+
+    Has to be called before the event loop is started. The uvloop loop is not
+    patched by nest_asyncio, nested calls to `asyncio.run` are not possible.
+    Falls back to the asyncio event loop if uvloop is not installed.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("package uvloop not installed, using asyncio event loop")
+        return
+    with contextlib.suppress(RuntimeError):
+        asyncio.get_event_loop_policy().get_event_loop().close()
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    # nest_asyncio's asyncio.run() picks up the current loop instead of creating one
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    logger.info("using uvloop event loop")
+
+
 MeasurementUnit = Literal[
     "displacement",
     "velocity",
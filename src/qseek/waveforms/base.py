@@ -20,7 +20,7 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(slots=True)
 class WaveformBatch:
     traces: list[Trace]
     start_time: datetime
@@ -65,8 +65,9 @@ class WaveformBatch:
         Returns:
             bool: True if the batch is empty, False otherwise.
         """
-        if self.n_stations < min_stations:
-            logger.warning("batch has only %d stations", self.n_stations)
+        n_stations = self.n_stations
+        if n_stations < min_stations:
+            logger.warning("batch has only %d stations", n_stations)
             return False
         if not self.traces:
             logger.warning("batch is empty")
@@ -75,19 +76,28 @@ class WaveformBatch:
 
     def clean_traces(self) -> None:
         """Remove empty or bad traces."""
+        good_traces = []
         good_nsl = set()
-        for tr in self.traces.copy():
-            if not tr.ydata.size or not np.all(np.isfinite(tr.ydata)):
+        for tr in self.traces:
+            if not tr.ydata.size or not _all_finite(tr.ydata):
                 logger.warning("skipping empty or bad trace: %s", ".".join(tr.nslc_id))
-                self.traces.remove(tr)
                 continue
 
             if tr.nslc_id in good_nsl:
                 logger.warning("removing duplicate trace: %s", ".".join(tr.nslc_id))
-                self.traces.remove(tr)
                 continue
 
             good_nsl.add(tr.nslc_id)
+            good_traces.append(tr)
+
+        self.traces[:] = good_traces
+
+
+def _all_finite(data: np.ndarray) -> bool:
+    # Integer samples can not hold NaN or inf, skip the element-wise check
+    if not np.issubdtype(data.dtype, np.inexact):
+        return True
+    return bool(np.isfinite(data).all())
 
 
 class WaveformProvider(BaseModel):
@@ -1,11 +1,23 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
 import glob
 import logging
-from datetime import datetime, timedelta
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import TYPE_CHECKING, AsyncIterator, ClassVar, Iterator, Literal
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    ClassVar,
+    Generator,
+    Literal,
+    Sequence,
+)
 
 from pydantic import (
     AwareDatetime,
@@ -23,7 +35,7 @@ from typing_extensions import Self
 
 from qseek.models.station import Stations
 from qseek.stats import Stats
-from qseek.utils import QUEUE_SIZE, datetime_now, human_readable_bytes, to_datetime
+from qseek.utils import QUEUE_SIZE, human_readable_bytes, to_datetime
 from qseek.waveforms.base import WaveformBatch, WaveformProvider
 
 if TYPE_CHECKING:
@@ -32,71 +44,309 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+_UTC = timezone.utc
+
+# Log only every n-th rejected batch, sparse networks produce many of them
+BATCH_WARNING_INTERVAL = 10
+
 
 class SquirrelPrefetcher:
-    queue: asyncio.Queue[Batch | None]
-    load_time: timedelta = timedelta(seconds=0.0)
+    """Reads waveform batches ahead of the consumer.
+
+    The worker keeps one read in flight while handing off the previous batch,
+    so it only stalls when `queue_size` batches are buffered. A deeper queue
+    hides more read latency at the cost of holding more waveform data in memory.
+    """
+
+    queue_size: int
+    load_time_ns: int = 0
+
+    autotune_interval: ClassVar[int] = 8
+    autotune_smoothing: ClassVar[float] = 0.2
 
-    _load_queue: asyncio.Queue[Batch | None]
     _fetched_batches: int
+    _exhausted: bool
+    _exception: Exception | None
+    _debug: bool
     _task: asyncio.Task[None]
-
-    def __init__(self, iterator: Iterator[Batch]) -> None:
-        self.iterator = iterator
-        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
-        self._load_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    _executor: ThreadPoolExecutor
+    _buffer: deque[Batch | None]
+    _nonempty: asyncio.Event
+    _nonfull: asyncio.Event
+
+    _load_time_avg_ns: float
+    _consume_time_avg_ns: float
+    _last_get_ns: int
+    _n_gets: int
+    _n_starved: int
+    _n_saturated: int
+
+    def __init__(
+        self,
+        iterators: Sequence[Generator[Batch, None, None]],
+        queue_size: int = 8,
+        max_queue_size: int | None = None,
+        autotune: bool = False,
+    ) -> None:
+        self.iterators = iterators
+        self.queue_size = queue_size
+        self.max_queue_size = max(max_queue_size or queue_size, queue_size)
+        self.autotune = autotune
         self._fetched_batches = 0
+        self._exhausted = False
+        self._exception = None
+        self._debug = logger.isEnabledFor(logging.DEBUG)
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(iterators),
+            thread_name_prefix="qseek-squirrel",
+        )
+        self._buffer = deque()
+        self._nonempty = asyncio.Event()
+        self._nonfull = asyncio.Event()
+        self._nonfull.set()
+
+        self._load_time_avg_ns = 0.0
+        self._consume_time_avg_ns = 0.0
+        self._last_get_ns = 0
+        self._n_gets = 0
+        self._n_starved = 0
+        self._n_saturated = 0
 
         self._task = asyncio.create_task(self.prefetch_worker())
 
+    async def _load_batch(self) -> Batch | None:
+        start_load = time.monotonic_ns()
+        if self._debug:
+            logger.debug("loading waveform batch %d", self._fetched_batches)
+        loop = asyncio.get_running_loop()
+        batches = await asyncio.gather(
+            *(
+                loop.run_in_executor(self._executor, next, iterator, None)
+                for iterator in self.iterators
+            )
+        )
+        if None in batches:
+            return None
+        batch = _merge_batches(batches)
+        self._fetched_batches += 1
+        self.load_time_ns = time.monotonic_ns() - start_load
+        self._load_time_avg_ns = _ewma(
+            self._load_time_avg_ns,
+            self.load_time_ns,
+            self.autotune_smoothing,
+        )
+        if self._debug:
+            logger.debug("read waveform batch in %.3f s", self.load_time_ns / 1e9)
+        return batch
+
     async def prefetch_worker(self) -> None:
         logger.info(
-            "start prefetching waveforms, queue size %d",
-            self.queue.maxsize,
+            "start prefetching waveforms, queue size %d%s",
+            self.queue_size,
+            f" (autotune up to {self.max_queue_size})" if self.autotune else "",
         )
 
-        async def load_data() -> None | Batch:
+        next_batch = asyncio.create_task(self._load_batch())
+        try:
             while True:
-                start_load = datetime_now()
-                logger.debug("loading waveform batch %d", self._fetched_batches)
-                batch = await asyncio.to_thread(next, self.iterator, None)
+                batch = await next_batch
                 if batch is None:
-                    await self.queue.put(None)
-                    return
-                logger.debug("read waveform batch in %s", datetime_now() - start_load)
-                self._fetched_batches += 1
-                self.load_time = datetime_now() - start_load
-                await self.queue.put(batch)
-
-        await asyncio.create_task(load_data())
+                    await self._put(None)
+                    break
+                # Start reading the next batch before we block on a full queue
+                next_batch = asyncio.create_task(self._load_batch())
+                try:
+                    self._put_nowait(batch)
+                except asyncio.QueueFull:
+                    await self._put(batch)
+        except Exception as exc:
+            # Hand the error to the consumer, regardless of the queue depth
+            self._exception = exc
+            self._buffer.append(None)
+            self._nonempty.set()
+            return
+        finally:
+            next_batch.cancel()
+
+        self._executor.shutdown(wait=False)
         logger.debug("done loading waveforms")
 
+    async def aclose(self) -> None:
+        """Stop prefetching, drop buffered batches and close the iterators."""
+        if not self._task.done():
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        self._buffer.clear()
+        self._nonfull.set()
+
+        # A read may still run on the executor, wait for it on a thread of
+        # our own, the default executor can be busy with processing jobs
+        loop = asyncio.get_running_loop()
+        closer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qseek-squirrel")
+        try:
+            await asyncio.shield(loop.run_in_executor(closer, self._close_iterators))
+        finally:
+            closer.shutdown(wait=False)
+
+    def _close_iterators(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for iterator in self.iterators:
+            iterator.close()
+
+    def qsize(self) -> int:
+        """Number of batches waiting for the consumer."""
+        return len(self._buffer)
+
+    def _put_nowait(self, batch: Batch | None) -> None:
+        if len(self._buffer) >= self.queue_size:
+            raise asyncio.QueueFull
+        self._buffer.append(batch)
+        self._nonempty.set()
+
+    async def _put(self, batch: Batch | None) -> None:
+        while len(self._buffer) >= self.queue_size:
+            self._nonfull.clear()
+            await self._nonfull.wait()
+        self._put_nowait(batch)
+
+    def _pop(self) -> Batch | None:
+        batch = self._buffer.popleft()
+        self._nonfull.set()
+        self._last_get_ns = time.monotonic_ns()
+        if batch is None and self._exception is not None:
+            self._exhausted = True
+            raise self._exception
+        return batch
+
+    def get_nowait(self) -> Batch | None:
+        """Get the next prefetched batch without waiting.
+
+        Returns:
+            Batch | None: The next batch or None if the iterator is exhausted.
+
+        Raises:
+            asyncio.QueueEmpty: If no batch is available yet.
+        """
+        if not self._buffer:
+            raise asyncio.QueueEmpty
+        if self.autotune:
+            self._observe_queue()
+        return self._pop()
+
+    async def get(self) -> Batch | None:
+        """Get the next prefetched batch.
+
+        Returns:
+            Batch | None: The next batch or None if the iterator is exhausted.
+        """
+        if self.autotune:
+            self._observe_queue()
+        while not self._buffer:
+            self._nonempty.clear()
+            await self._nonempty.wait()
+        return self._pop()
+
+    def __aiter__(self) -> Self:
+        return self
+
+    async def __anext__(self) -> Batch:
+        if self._exhausted:
+            raise StopAsyncIteration
+        try:
+            batch = self.get_nowait()
+        except asyncio.QueueEmpty:
+            batch = await self.get()
+        if batch is None:
+            self._exhausted = True
+            raise StopAsyncIteration
+        return batch
+
+    def _observe_queue(self) -> None:
+        if self._last_get_ns:
+            self._consume_time_avg_ns = _ewma(
+                self._consume_time_avg_ns,
+                time.monotonic_ns() - self._last_get_ns,
+                self.autotune_smoothing,
+            )
+        n_queued = len(self._buffer)
+        if n_queued == 0:
+            self._n_starved += 1
+        elif n_queued >= self.queue_size:
+            self._n_saturated += 1
+
+        self._n_gets += 1
+        if self._n_gets % self.autotune_interval == 0:
+            self._tune_queue_size()
+
+    def _tune_queue_size(self) -> None:
+        # Number of batches the consumer works through while one batch is loaded
+        target = 2
+        if self._consume_time_avg_ns > 0.0:
+            target = math.ceil(self._load_time_avg_ns / self._consume_time_avg_ns) + 1
+
+        queue_size = self.queue_size
+        if self._n_starved:
+            queue_size = max(queue_size + 1, target)
+        elif self._n_saturated == self.autotune_interval:
+            queue_size = max(queue_size - 1, target)
+        queue_size = min(max(queue_size, 1), self.max_queue_size)
+
+        if queue_size != self.queue_size:
+            logger.debug("prefetch queue size %d -> %d", self.queue_size, queue_size)
+            self.queue_size = queue_size
+            self._nonfull.set()
+        self._n_starved = 0
+        self._n_saturated = 0
+
+
+def _merge_batches(batches: list[Batch]) -> Batch:
+    # All shards chop the same time windows, batch i lines up across shards
+    batch, *shard_batches = batches
+    for shard_batch in shard_batches:
+        batch.traces.extend(shard_batch.traces)
+    return batch
+
+
+def _ewma(average: float, value: float, alpha: float) -> float:
+    if not average:
+        return float(value)
+    return alpha * value + (1.0 - alpha) * average
+
 
 class SquirrelStats(Stats):
     empty_batches: PositiveInt = 0
     short_batches: PositiveInt = 0
-    time_per_batch: timedelta = timedelta(seconds=0.0)
     bytes_per_seconds: float = 0.0
 
-    _queue: asyncio.Queue[Batch | None] | None = PrivateAttr(None)
+    _time_per_batch_ns: int = PrivateAttr(0)
+    _prefetcher: SquirrelPrefetcher | None = PrivateAttr(None)
     _position: int = PrivateAttr(20)
 
-    def set_queue(self, queue: asyncio.Queue[Batch | None]) -> None:
-        self._queue = queue
+    def set_prefetcher(self, prefetcher: SquirrelPrefetcher) -> None:
+        self._prefetcher = prefetcher
+
+    def set_time_per_batch(self, time_ns: int) -> None:
+        self._time_per_batch_ns = time_ns
+
+    @computed_field
+    @property
+    def time_per_batch(self) -> timedelta:
+        return timedelta(microseconds=self._time_per_batch_ns // 1000)
 
     @computed_field
     @property
     def queue_size(self) -> PositiveInt:
-        if self._queue is None:
+        if self._prefetcher is None:
             return 0
-        return self._queue.qsize()
+        return self._prefetcher.qsize()
 
     @computed_field
     @property
     def queue_size_max(self) -> PositiveInt:
-        if self._queue is None:
+        if self._prefetcher is None:
             return 0
-        return self._queue.maxsize
+        return self._prefetcher.queue_size
 
     def _populate_table(self, table: Table) -> None:
         prefix = "[bold red]" if self.queue_size <= 1 else ""
@@ -150,6 +400,27 @@ class PyrockoSquirrel(WaveformProvider):
         description="Number of threads for loading waveforms,"
         " important for large data sets.",
     )
+    async_prefetch_batches: PositiveInt = Field(
+        default=8,
+        description="Number of waveform batches to read ahead of the search. "
+        "More batches hide I/O latency, but each buffered batch is held in memory.",
+    )
+    prefetch_shards: PositiveInt = Field(
+        default=1,
+        description="Number of parallel readers, each loading waveforms for a "
+        "subset of the stations. Helps with large networks when a single reader "
+        "cannot saturate the storage bandwidth.",
+    )
+    async_prefetch_batches_max: PositiveInt = Field(
+        default=QUEUE_SIZE,
+        description="Upper bound for the number of prefetched waveform batches "
+        "when `autotune_prefetch` is enabled.",
+    )
+    autotune_prefetch: bool = Field(
+        default=True,
+        description="Adapt the number of prefetched batches to the measured "
+        "loading and processing times.",
+    )
     watch_waveforms: bool | timedelta = Field(
         default=False,
         description="Watch the waveform directories for changes. If `True` it will "
@@ -159,6 +430,8 @@ class PyrockoSquirrel(WaveformProvider):
 
     _squirrel: Squirrel | None = PrivateAttr(None)
     _stations: Stations = PrivateAttr(None)
+    _codes: list[tuple[str, str, str, str]] = PrivateAttr(default_factory=list)
+    _waveform_paths: tuple[list[str], list[str]] | None = PrivateAttr(None)
     _stats: ClassVar[SquirrelStats] = SquirrelStats()
 
     @model_validator(mode="after")
@@ -171,6 +444,10 @@ class PyrockoSquirrel(WaveformProvider):
             raise ValueError("watch_waveforms requires waveform_dirs")
         if self.watch_waveforms and self.end_time:
             raise ValueError("watch_waveforms does not support end_time")
+        if self.async_prefetch_batches_max < self.async_prefetch_batches:
+            raise ValueError(
+                "async_prefetch_batches_max must be >= async_prefetch_batches"
+            )
         return self
 
     @field_validator("watch_waveforms", mode="after")
@@ -220,19 +497,53 @@ class PyrockoSquirrel(WaveformProvider):
             "scanning waveform directories %s",
             ".".join(map(str, self.waveform_dirs)),
         )
+        waveform_paths, waveform_globs = self._get_waveform_paths()
+        paths = waveform_paths.copy()
+        for pattern in waveform_globs:
+            paths.extend(glob.glob(pattern, recursive=True))
+        squirrel.add(paths, check=False)
+
+    def _get_waveform_paths(self) -> tuple[list[str], list[str]]:
+        """Resolve the waveform directories into plain paths and glob patterns.
+
+        Returns:
+            tuple[list[str], list[str]]: Paths to add and patterns to glob.
+        """
+        if self._waveform_paths is not None:
+            return self._waveform_paths
+
         paths = []
-        for path in self.waveform_dirs:
-            if "**" in str(path):
-                paths.extend(glob.glob(str(path.expanduser()), recursive=True))
+        patterns = []
+        for waveform_dir in self.waveform_dirs:
+            path = Path(waveform_dir).expanduser()
+            if path.name == "**" and "**" not in str(path.parent):
+                # Squirrel walks directories recursively, no need to glob
+                paths.append(str(path.parent))
+            elif "**" in str(path):
+                patterns.append(str(path))
             else:
-                paths.append(str(path.expanduser()))
-        squirrel.add(paths, check=False)
+                paths.append(str(path))
+        self._waveform_paths = paths, patterns
+        return self._waveform_paths
+
+    def release(self) -> None:
+        """Drop the Squirrel instance and its in-memory caches.
+
+        The file index is kept in the Squirrel database, the next call to
+        `get_squirrel()` re-opens it without indexing the file contents again.
+        """
+        if self._squirrel is None:
+            return
+        logger.info("releasing squirrel environment")
+        self._squirrel = None
 
     def prepare(self, stations: Stations) -> None:
         logger.info("preparing squirrel waveform provider")
         self._stations = stations
         squirrel = self.get_squirrel()
         stations.weed_from_squirrel_waveforms(squirrel)
+        # Squirrel only accepts a list for multiple codes, tuples are a single code
+        self._codes = [(*nsl, "*") for nsl in stations.get_all_nsl()]
 
     async def iter_batches(
         self,
@@ -248,6 +559,13 @@ class PyrockoSquirrel(WaveformProvider):
 
         squirrel = self.get_squirrel()
         stats = self._stats
+        tinc = window_increment.total_seconds()
+        tpad = window_padding.total_seconds()
+        min_duration = min_length.total_seconds() if min_length else 0.0
+
+        codes = self._codes
+        n_shards = min(self.prefetch_shards, len(codes)) or 1
+        accessor_ids = [f"qseek-shard-{i_shard}" for i_shard in range(n_shards)]
 
         if self.watch_waveforms:
             logger.info("scanning for new waveforms every %s", self.watch_waveforms)
@@ -270,78 +588,113 @@ class PyrockoSquirrel(WaveformProvider):
                 chop_end_time - chop_start_time,
             )
 
-            iterator = squirrel.chopper_waveforms(
-                tmin=(chop_start_time + window_padding).timestamp(),
-                tmax=(chop_end_time - window_padding).timestamp(),
-                tinc=window_increment.total_seconds(),
-                tpad=window_padding.total_seconds(),
-                want_incomplete=False,
-                codes=[(*nsl, "*") for nsl in self._stations.get_all_nsl()],
-                channel_priorities=self.channel_selector,
+            tmin = chop_start_time.timestamp() + tpad
+            tmax = chop_end_time.timestamp() - tpad
+            iterators = [
+                squirrel.chopper_waveforms(
+                    tmin=tmin,
+                    tmax=tmax,
+                    tinc=tinc,
+                    tpad=tpad,
+                    want_incomplete=False,
+                    codes=codes[i_shard::n_shards],
+                    channel_priorities=self.channel_selector,
+                    accessor_id=accessor_id,
+                )
+                for i_shard, accessor_id in enumerate(accessor_ids)
+            ]
+            prefetcher = SquirrelPrefetcher(
+                iterators,
+                queue_size=self.async_prefetch_batches,
+                max_queue_size=self.async_prefetch_batches_max,
+                autotune=self.autotune_prefetch,
             )
-            prefetcher = SquirrelPrefetcher(iterator)
-            stats.set_queue(prefetcher.queue)
+            stats.set_prefetcher(prefetcher)
             return prefetcher
 
+        async def close_prefetcher(prefetcher: SquirrelPrefetcher) -> None:
+            try:
+                await prefetcher.aclose()
+            finally:
+                for accessor_id in accessor_ids:
+                    squirrel.clear_accessor(accessor_id)
+
         prefetcher = init_prefetcher(chop_start_time=start_time, chop_end_time=end_time)
         last_batch_end_time = None
 
-        while True:
-            start = datetime_now()
-            pyrocko_batch = await prefetcher.queue.get()
-
-            if pyrocko_batch is None:
-                if isinstance(self.watch_waveforms, timedelta):
-                    logger.info(
-                        "re-scanning waveform directories in %s", self.watch_waveforms
-                    )
-
-                    await asyncio.sleep(self.watch_waveforms.total_seconds())
-                    self.scan_waveform_dirs(squirrel)
-                    prefetcher = init_prefetcher(
-                        chop_start_time=last_batch_end_time,
-                        chop_end_time=None,
-                        trim_end=timedelta(seconds=30),  # Trim as SeedLink is slow!
+        try:
+            while True:
+                async for pyrocko_batch in prefetcher:
+                    start = time.monotonic_ns()
+
+                    # Reject empty and short batches before building and cleaning them
+                    if not pyrocko_batch.traces:
+                        stats.empty_batches += 1
+                        if stats.empty_batches % BATCH_WARNING_INTERVAL == 1:
+                            logger.warning(
+                                "empty batch %d - %s (%d unhealthy batches)",
+                                pyrocko_batch.i,
+                                to_datetime(pyrocko_batch.tmin),
+                                stats.empty_batches,
+                            )
+                        continue
+
+                    duration = pyrocko_batch.tmax - pyrocko_batch.tmin
+                    if duration < min_duration:
+                        stats.short_batches += 1
+                        if stats.short_batches % BATCH_WARNING_INTERVAL == 1:
+                            logger.warning(
+                                "duration of batch %d too short %s (%d short batches)",
+                                pyrocko_batch.i,
+                                timedelta(seconds=duration),
+                                stats.short_batches,
+                            )
+                        continue
+
+                    batch = WaveformBatch(
+                        traces=pyrocko_batch.traces,
+                        start_time=datetime.fromtimestamp(pyrocko_batch.tmin, _UTC),
+                        end_time=datetime.fromtimestamp(pyrocko_batch.tmax, _UTC),
+                        i_batch=pyrocko_batch.i,
+                        n_batches=pyrocko_batch.n,
                     )
-                    continue
-                else:
+                    batch.clean_traces()
+
+                    stats.set_time_per_batch(time.monotonic_ns() - start)
+                    if prefetcher.load_time_ns:
+                        stats.bytes_per_seconds = (
+                            batch.cumulative_bytes * 1e9 / prefetcher.load_time_ns
+                        )
+
+                    # Not is_healthy(), which warns for every rejected batch
+                    if not batch.traces or batch.n_stations < min_stations:
+                        stats.empty_batches += 1
+                        if stats.empty_batches % BATCH_WARNING_INTERVAL == 1:
+                            logger.warning(
+                                "unhealthy batch %d - %s (%d unhealthy batches)",
+                                batch.i_batch,
+                                batch.start_time,
+                                stats.empty_batches,
+                            )
+                        continue
+
+                    last_batch_end_time = batch.end_time
+                    yield batch
+
+                if not isinstance(self.watch_waveforms, timedelta):
                     logger.debug("no more waveforms to load")
-                    prefetcher.queue.task_done()
                     break
 
-            batch = WaveformBatch(
-                traces=pyrocko_batch.traces,
-                start_time=to_datetime(pyrocko_batch.tmin),
-                end_time=to_datetime(pyrocko_batch.tmax),
-                i_batch=pyrocko_batch.i,
-                n_batches=pyrocko_batch.n,
-            )
-            batch.clean_traces()
-
-            stats.time_per_batch = datetime_now() - start
-            stats.bytes_per_seconds = (
-                batch.cumulative_bytes / prefetcher.load_time.total_seconds()
-            )
-
-            if not batch.is_healthy(min_stations=min_stations):
-                logger.warning(
-                    "unhealthy batch %d - %s",
-                    batch.i_batch,
-                    batch.start_time,
+                await close_prefetcher(prefetcher)
+                logger.info(
+                    "re-scanning waveform directories in %s", self.watch_waveforms
                 )
-                stats.empty_batches += 1
-                continue
-
-            if min_length and batch.duration < min_length:
-                logger.warning(
-                    "duration of batch %d too short %s",
-                    batch.i_batch,
-                    batch.duration,
+                await asyncio.sleep(self.watch_waveforms.total_seconds())
+                self.scan_waveform_dirs(squirrel)
+                prefetcher = init_prefetcher(
+                    chop_start_time=last_batch_end_time,
+                    chop_end_time=None,
+                    trim_end=timedelta(seconds=30),  # Trim as SeedLink is slow!
                 )
-                stats.short_batches += 1
-                continue
-
-            last_batch_end_time = batch.end_time
-            yield batch
-
-            prefetcher.queue.task_done()
+        finally:
+            await close_prefetcher(prefetcher)
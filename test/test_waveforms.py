@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Generator
+
+import numpy as np
+import pytest
+from pyrocko import io
+from pyrocko.squirrel import init_environment
+from pyrocko.squirrel.base import Batch
+from pyrocko.trace import Trace
+
+from qseek.models.station import Station, Stations
+from qseek.waveforms.base import WaveformBatch
+from qseek.waveforms.squirrel import PyrockoSquirrel, SquirrelPrefetcher
+
+N_STATIONS = 3
+
+
+def fake_chopper(
+    shard: str,
+    n_batches: int,
+    load_time: float = 0.0,
+) -> Generator[Batch, None, None]:
+    for i in range(n_batches):
+        time.sleep(load_time)
+        yield Batch(
+            tmin=i * 10.0,
+            tmax=(i + 1) * 10.0,
+            tpad=0.0,
+            i=i,
+            n=n_batches,
+            igroup=0,
+            ngroups=1,
+            traces=[f"{shard}{i}"],
+        )
+
+
+async def consume(
+    prefetcher: SquirrelPrefetcher,
+    consume_time: float = 0.0,
+) -> list[Batch]:
+    batches = []
+    while (batch := await prefetcher.get()) is not None:
+        batches.append(batch)
+        await asyncio.sleep(consume_time)
+    return batches
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_merge_shards():
+    prefetcher = SquirrelPrefetcher(
+        [fake_chopper("a", 5), fake_chopper("b", 5), fake_chopper("c", 5)]
+    )
+    batches = await consume(prefetcher)
+
+    assert [batch.i for batch in batches] == list(range(5))
+    for batch in batches:
+        assert batch.traces == [f"a{batch.i}", f"b{batch.i}", f"c{batch.i}"]
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_autotune_grow():
+    # Slow reads, the consumer finds the queue empty
+    prefetcher = SquirrelPrefetcher(
+        [fake_chopper("a", 20, load_time=0.005)],
+        queue_size=1,
+        max_queue_size=4,
+        autotune=True,
+    )
+    assert len(await consume(prefetcher)) == 20
+
+    assert prefetcher.queue_size > 1
+    assert prefetcher.queue_size <= 4
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_autotune_shrink():
+    # Fast reads, the queue stays full while the consumer works
+    prefetcher = SquirrelPrefetcher(
+        [fake_chopper("a", 32)],
+        queue_size=4,
+        autotune=True,
+    )
+    await asyncio.sleep(0.05)
+    assert len(await consume(prefetcher, consume_time=0.005)) == 32
+
+    assert prefetcher.queue_size < 4
+    assert prefetcher.queue_size >= 1
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_exception():
+    def failing_chopper() -> Generator[Batch, None, None]:
+        yield from fake_chopper("a", 2)
+        raise ValueError("bad waveform file")
+
+    prefetcher = SquirrelPrefetcher([failing_chopper()])
+    batches = []
+    with pytest.raises(ValueError, match="bad waveform file"):
+        async for batch in prefetcher:
+            batches.append(batch)
+    assert len(batches) == 2
+
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(anext(prefetcher), timeout=1.0)
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_aclose():
+    closed = {}
+
+    def endless_chopper(shard: str) -> Generator[Batch, None, None]:
+        try:
+            yield from fake_chopper(shard, 1_000_000)
+        finally:
+            closed[shard] = threading.current_thread().name
+
+    prefetcher = SquirrelPrefetcher(
+        [endless_chopper("a"), endless_chopper("b")], queue_size=4
+    )
+    batch = await anext(prefetcher)
+    assert batch.i == 0
+
+    await prefetcher.aclose()
+    assert sorted(closed) == ["a", "b"]
+    assert all(name.startswith("qseek-squirrel") for name in closed.values())
+    assert prefetcher.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_exhausted():
+    prefetcher = SquirrelPrefetcher([fake_chopper("a", 3)])
+    assert len([batch async for batch in prefetcher]) == 3
+
+    # The sentinel is consumed once, later calls must not wait for more batches
+    for _ in range(2):
+        with pytest.raises(StopAsyncIteration):
+            await asyncio.wait_for(anext(prefetcher), timeout=1.0)
+
+
+@pytest.fixture
+def squirrel_data(tmp_path: Path) -> tuple[Path, Stations]:
+    init_environment(str(tmp_path))
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+
+    traces = [
+        Trace(
+            "XX",
+            f"S{i_sta}",
+            "",
+            channel,
+            tmin=0.0,
+            deltat=0.01,
+            ydata=np.zeros(360_000, dtype=np.int32),
+        )
+        for i_sta in range(N_STATIONS)
+        for channel in ("HHZ", "HHN")
+    ]
+    io.save(traces, str(data_dir / "%(station)s.%(channel)s.mseed"))
+
+    stations = Stations(
+        stations=[
+            Station(network="XX", station=f"S{i_sta}", lat=10.0 + i_sta, lon=10.0)
+            for i_sta in range(N_STATIONS)
+        ]
+    )
+    return tmp_path, stations
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("prefetch_shards", [1, 2])
+async def test_squirrel_iter_batches(
+    squirrel_data: tuple[Path, Stations], prefetch_shards: int
+):
+    env_dir, stations = squirrel_data
+    provider = PyrockoSquirrel(
+        environment=env_dir,
+        waveform_dirs=[env_dir / "data"],
+        prefetch_shards=prefetch_shards,
+    )
+    provider.prepare(stations)
+
+    batches = [
+        batch
+        async for batch in provider.iter_batches(
+            window_increment=timedelta(minutes=10),
+            window_padding=timedelta(seconds=10),
+        )
+    ]
+
+    assert [batch.i_batch for batch in batches] == list(range(len(batches)))
+    assert len(batches) == batches[0].n_batches
+    for batch in batches:
+        assert batch.n_stations == N_STATIONS
+        assert len(batch.traces) == N_STATIONS * 2
+
+
+def test_squirrel_waveform_paths():
+    provider = PyrockoSquirrel(
+        waveform_dirs=[
+            Path("data/plain"),
+            Path("~/data/home"),
+            Path("data/recursive/**"),
+            Path("data/**/*.mseed"),
+        ]
+    )
+    paths, patterns = provider._get_waveform_paths()
+
+    assert paths == [
+        "data/plain",
+        str(Path.home() / "data" / "home"),
+        "data/recursive",
+    ]
+    assert patterns == ["data/**/*.mseed"]
+
+    # The default is not validated and holds plain strings
+    assert PyrockoSquirrel()._get_waveform_paths() == (["data"], [])
+
+
+def test_clean_traces():
+    def trace(station: str, ydata: np.ndarray, channel: str = "HHZ") -> Trace:
+        return Trace("XX", station, "", channel, deltat=0.01, ydata=ydata)
+
+    good_int = trace("GOOD", np.zeros(100, dtype=np.int32))
+    good_float = trace("GOOD", np.zeros(100, dtype=np.float32), channel="HHN")
+    traces = [
+        good_int,
+        trace("EMPTY", np.zeros(0, dtype=np.int32)),
+        trace("NAN", np.full(100, np.nan)),
+        trace("INF", np.full(100, np.inf)),
+        trace("GOOD", np.ones(100, dtype=np.int32)),
+        good_float,
+    ]
+    batch = WaveformBatch(
+        traces=traces,
+        start_time=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        end_time=datetime(2024, 1, 2, tzinfo=timezone.utc),
+        i_batch=0,
+    )
+    batch.clean_traces()
+
+    assert batch.traces is traces
+    assert batch.traces == [good_int, good_float]